@@ -6,10 +6,14 @@ Usage:
     --graph: Path to the input knowledge graph pickle file (required).
     --symptoms: Path to the input symptoms file (required).
     --output: Path to the output possible diseases file, default is possible_diseases.txt.
+    --top_k: Only output the given positive number of most likely diseases, default is all of them.
+    --cost_cutoff: Only output diseases with a cumulative cost of at most this value, default is no cutoff.
+    --engine: Search engine, astar (default) or igraph, which requires the optional igraph package.
 
     Example:
         `python3 get_diagnosis.py --graph knowledge_graph.pkl --symptoms symptoms.txt`
         `python3 get_diagnosis.py --graph knowledge_graph.pkl --symptoms symptoms.txt --output possible_diseases.txt`
+        `python3 get_diagnosis.py --graph knowledge_graph.pkl --symptoms symptoms.txt --top_k 10`
 
 Input Format:
     symptoms.txt
@@ -29,147 +33,316 @@ Output Format:
 
 Notes:
     - The A* algorithm uses the negative logarithm of association strengths as costs.
+    - The graph is searched in CSR form (indptr/indices/weights arrays keyed by integer node ids)
+      by a Numba-compiled kernel; the first run pays a one-off compilation that is cached on disk.
     - The heuristic function estimates the minimal remaining cost to reach any disease.
     - Diseases with lower cumulative costs are ranked higher (more likely).
 '''
 
-import os
-# set the number of threads to 1 for better performance cuz purdue server sucks!
-os.environ["OPENBLAS_NUM_THREADS"] = "1"
-os.environ["OMP_NUM_THREADS"] = "1"
 import argparse
 import pickle
 import networkx as nx
-from math import log
+import numpy as np
 from heapq import heappush, heappop
+from numba import njit, prange
+
+# Number of fixed-width buckets in the open list of the A* kernel
+N_BUCKETS = 256
+
+def neg_log_weights(raw_weights):
+    """
+    Calculate the cost to traverse each edge using negative logarithm of the weight.
+    """
+    raw_weights = np.asarray(raw_weights, dtype=np.float32)
+    # Assign infinite cost for zero or negative weights, masked once here so the A* kernel never tests for them
+    invalid = raw_weights <= 0
+    weights = -np.log(np.where(invalid, np.float32(1.0), raw_weights))
+    weights[invalid] = np.inf
+    return weights
+
+def graph_to_csr(G):
+    """
+    Convert the knowledge graph into CSR adjacency arrays indexed by integer node ids.
+    Returns (indptr, indices, weights, is_disease, name_to_id, id_to_name), where the neighbors of
+    node u are indices[indptr[u]:indptr[u+1]] and weights holds the negative logarithm of the edge weights.
+    """
+    id_to_name = list(G.nodes())
+    name_to_id = {node: i for i, node in enumerate(id_to_name)}
+    indptr = np.zeros(len(id_to_name) + 1, dtype=np.int32)
+    indices = []
+    raw_weights = []
+    for i, node in enumerate(id_to_name):
+        for neighbor, data in G[node].items():
+            indices.append(name_to_id[neighbor])
+            raw_weights.append(data.get('weight', 0.0))
+        indptr[i + 1] = len(indices)
+    indices = np.array(indices, dtype=np.int32)
+    weights = neg_log_weights(raw_weights)
+    is_disease = np.array([G.nodes[node].get('group') == 'disease' for node in id_to_name], dtype=np.bool_)
+    return indptr, indices, weights, is_disease, name_to_id, id_to_name
 
 def load_graph(graph_path):
     with open(graph_path, 'rb') as f:
-        G = pickle.load(f)
-    return G
+        graph = pickle.load(f)
+    # Pickles written by older versions of get_knowledge_graph.py hold the NetworkX graph itself
+    if isinstance(graph, nx.Graph):
+        graph = graph_to_csr(graph)
+    return graph
 
 def load_symptoms(symptoms_path):
     with open(symptoms_path, 'r', encoding='utf-8') as f:
         symptoms = [line.strip().lower() for line in f if line.strip()]
     return symptoms
 
-def heuristic(node, G):
+def precompute_heuristic(indptr, weights, is_disease):
     """
-    Heuristic function: estimate the minimal remaining cost to reach any disease from the current node.
-    We use the minimum negative log(weight) among all connected edges.
+    Heuristic function: estimate the minimal remaining cost to reach any disease from each node.
+    We use the minimum negative log(weight) among all connected edges, zero for diseases and isolated nodes.
     """
-    if G.nodes[node].get('group') == 'disease':
-        return 0
-    # Find the minimum negative log(weight) of edges connected to this node
-    weights = [edge_weight(G, node, neighbor) for neighbor in G.neighbors(node)]
-    if not weights:
-        return 0  # No connected edges, heuristic is zero
-    min_cost = min(weights)
-    return min_cost
+    h = np.zeros(len(is_disease), dtype=np.float32)
+    # reduceat cannot express empty segments, so only reduce over nodes that have edges
+    has_edges = indptr[1:] > indptr[:-1]
+    if has_edges.any():
+        h[has_edges] = np.minimum.reduceat(weights, indptr[:-1][has_edges])
+    h[is_disease] = 0.0
+    return h
 
-def edge_weight(G, u, v):
+@njit(cache=True)
+def _bucket_index(f, f_min, bucket_width, current_bucket, n_buckets):
     """
-    Calculate the cost to traverse an edge using negative logarithm of the weight.
+    Bucket of the open list an entry with estimated total cost f belongs to, n_buckets meaning the overflow heap.
     """
-    weight = G[u][v].get('weight', 0.0)
-    if weight <= 0:
-        return float('inf')  # Assign infinite cost for zero or negative weights
-    return -log(weight)
+    b = int((f - f_min) / bucket_width)
+    # f never decreases along the search, clamp float rounding so the bucket pointer only moves forward
+    if b < current_bucket:
+        b = current_bucket
+    if b > n_buckets:
+        b = n_buckets
+    return b
 
-def a_star_search(G, symptoms):
+@njit('Tuple((int32[::1], float32[::1]))(int32[:], int32[:], float32[:], boolean[:], float32[:], int32, int64, int64, float64, int64, float64)', cache=True)
+def _astar_csr_single(indptr, indices, weights, is_disease, h, start_id, n_nodes, n_buckets, bucket_width, top_k, cost_cutoff):
     """
-    Perform A* search from the symptoms to all possible diseases.
-    Returns a list of diseases sorted by their cumulative costs in ascending order.
-    """
-    # Initialize priority queue
-    queue = []
-    # Initialize costs dictionary
-    costs = {}
-    # Initialize visited set
-    visited = set()
-    
-    # Initialize the queue with all symptoms as starting points
-    for symptom in symptoms:
-        heappush(queue, (heuristic(symptom, G), symptom, 0))
-        costs[symptom] = 0
-    
-    while queue:
-        estimated_total_cost, current_node, current_cost = heappop(queue)
-        
-        if current_node in visited:
+    A* kernel over the CSR arrays from a single symptom, compiled with Numba.
+    Returns the ids and cumulative costs of the reached diseases, in the order they were settled.
+    The search stops once top_k diseases are settled (0 for no limit) or the estimated cost exceeds cost_cutoff.
+    """
+    costs = np.full(n_nodes, np.inf, dtype=np.float32)
+    # Diseases are recorded as they are popped, so no pass over all nodes is needed afterwards
+    disease_ids = np.empty(n_nodes, dtype=np.int32)
+    disease_costs = np.empty(n_nodes, dtype=np.float32)
+    n_diseases = 0
+
+    # Monotone bucket queue: the heuristic is consistent, so popped estimated total costs never decrease.
+    # The open list is split into n_buckets buckets of bucket_width starting at f_min, scanned by a pointer
+    # that only advances, each bucket being a small heap of (estimated total cost, node id) to keep the exact
+    # A* order. Entries past the last bucket fall back to a single overflow heap.
+    f_min = h[start_id]
+    buckets = [[(np.float32(0.0), np.int32(0)) for _ in range(0)] for _ in range(n_buckets + 1)]
+    current_bucket = 0
+
+    costs[start_id] = 0.0
+    heappush(buckets[current_bucket], (h[start_id], start_id))
+
+    while True:
+        # Advance to the first non-empty bucket, the overflow heap being the last one
+        while current_bucket < n_buckets and len(buckets[current_bucket]) == 0:
+            current_bucket += 1
+        if len(buckets[current_bucket]) == 0:
+            break
+        estimated_total_cost, u = heappop(buckets[current_bucket])
+        # Skip stale entries, a cheaper path to u was pushed after this one
+        if estimated_total_cost > costs[u] + h[u]:
             continue
-        visited.add(current_node)
-        
-        # If the current node is a disease, record its cumulative cost
-        if G.nodes[current_node].get('group') == 'disease':
-            costs[current_node] = current_cost
+        # Popped estimates never decrease, so every disease left costs more than the cutoff
+        if estimated_total_cost > cost_cutoff:
+            break
+
+        # Diseases are terminal, record their cumulative cost
+        if is_disease[u]:
+            disease_ids[n_diseases] = u
+            disease_costs[n_diseases] = costs[u]
+            n_diseases += 1
+            # Settled diseases are final, the next ones can only cost more
+            if n_diseases == top_k:
+                break
             continue
-        
-        # Explore neighbors
-        for neighbor in G.neighbors(current_node):
-            if neighbor in visited:
-                continue
-            cost = edge_weight(G, current_node, neighbor)
-            if cost == float('inf'):
-                continue
-            neighbor_cost = current_cost + cost
-            # If this path to neighbor is better, record it
-            if neighbor not in costs or neighbor_cost < costs[neighbor]:
-                costs[neighbor] = neighbor_cost
-                estimated_cost = neighbor_cost + heuristic(neighbor, G)
-                heappush(queue, (estimated_cost, neighbor, neighbor_cost))
-    
-    # Extract diseases and their cumulative costs
-    disease_scores = {}
-    for node, data in G.nodes(data=True):
-        if data.get('group') == 'disease' and node in costs:
-            disease_scores[node] = costs[node]
-    
-    # Sort diseases by cumulative cost in ascending order (lower cost means higher likelihood)
-    sorted_diseases = sorted(disease_scores.items(), key=lambda x: x[1])
+
+        # Explore neighbors, edges with infinite cost never improve costs[v]
+        current_cost = costs[u]
+        for j in range(indptr[u], indptr[u + 1]):
+            v = indices[j]
+            neighbor_cost = current_cost + weights[j]
+            if neighbor_cost < costs[v]:
+                costs[v] = neighbor_cost
+                f = neighbor_cost + h[v]
+                heappush(buckets[_bucket_index(f, f_min, bucket_width, current_bucket, n_buckets)], (f, v))
+    # Copies, so the node-sized buffers are freed as soon as the search returns
+    return disease_ids[:n_diseases].copy(), disease_costs[:n_diseases].copy()
+
+@njit('Tuple((int32[:], float32[:]))(int32[:], int32[:], float32[:], boolean[:], float32[:], int32[:], int64, int64, int64, float64)', parallel=True, cache=True)
+def _astar_csr(indptr, indices, weights, is_disease, h, start_ids, n_nodes, n_buckets, top_k, cost_cutoff):
+    """
+    Run one A* search per symptom on parallel threads.
+    Returns the disease ids and costs reached from every symptom, concatenated, so a disease may appear once per symptom.
+    """
+    # The buckets cover [f_min, f_min + max edge cost] of each search
+    max_cost = 0.0
+    for w in weights:
+        if w != np.inf and w > max_cost:
+            max_cost = w
+    bucket_width = max_cost / n_buckets if max_cost > 0 else 1.0
+
+    # Each search only sets its own slot of the lists
+    hit_ids = [np.empty(0, dtype=np.int32) for _ in range(len(start_ids))]
+    hit_costs = [np.empty(0, dtype=np.float32) for _ in range(len(start_ids))]
+    for i in prange(len(start_ids)):
+        hit_ids[i], hit_costs[i] = _astar_csr_single(indptr, indices, weights, is_disease, h, start_ids[i], n_nodes,
+                                                     n_buckets, bucket_width, top_k, cost_cutoff)
+
+    n_hits = 0
+    for i in range(len(start_ids)):
+        n_hits += len(hit_ids[i])
+    disease_ids = np.empty(n_hits, dtype=np.int32)
+    disease_costs = np.empty(n_hits, dtype=np.float32)
+    offset = 0
+    for i in range(len(start_ids)):
+        disease_ids[offset:offset + len(hit_ids[i])] = hit_ids[i]
+        disease_costs[offset:offset + len(hit_ids[i])] = hit_costs[i]
+        offset += len(hit_ids[i])
+    return disease_ids, disease_costs
+
+def a_star_search(graph, symptoms, top_k=None, cost_cutoff=None):
+    """
+    Perform A* search from the symptoms to all possible diseases.
+    Returns a list of diseases sorted by their cumulative costs in ascending order,
+    limited to the top_k most likely ones and to costs of at most cost_cutoff when given.
+    """
+    if top_k is not None and top_k < 1:
+        raise ValueError(f"top_k must be a positive integer, got {top_k}")
+    indptr, indices, weights, is_disease, name_to_id, id_to_name = graph
+    # Repeated symptoms would run the same search twice
+    start_ids = np.unique(np.array([name_to_id[symptom] for symptom in symptoms], dtype=np.int32))
+    if len(start_ids) == 0:
+        return []
+    h = precompute_heuristic(indptr, weights, is_disease)
+    # Each symptom keeps its own top_k cheapest diseases, which contain the top_k cheapest diseases overall
+    disease_ids, disease_costs = _astar_csr(indptr, indices, weights, is_disease, h, start_ids, len(id_to_name), N_BUCKETS,
+                                            top_k or 0, np.inf if cost_cutoff is None else cost_cutoff)
+    # Edge costs are nonnegative, so the cost from all symptoms is the minimum over the single-symptom costs:
+    # after sorting the hits by cost, the first hit of each disease is its cheapest one
+    order = np.argsort(disease_costs, kind='stable')
+    disease_ids, first = np.unique(disease_ids[order], return_index=True)
+    disease_costs = disease_costs[order][first]
+    
+    # Sort the reached diseases by cumulative cost in ascending order (lower cost means higher likelihood)
+    order = np.argsort(disease_costs, kind='stable')[:top_k]
+    sorted_diseases = [(id_to_name[node], cost) for node, cost in zip(disease_ids[order].tolist(), disease_costs[order].tolist())]
+    
+    return sorted_diseases
+
+def igraph_search(graph, symptoms, top_k=None, cost_cutoff=None):
+    """
+    Same ranking as a_star_search, computed with the Dijkstra shortest paths of igraph's C core.
+    Diseases are terminal, so the igraph graph is directed and only keeps the edges leaving non-disease nodes.
+    """
+    if top_k is not None and top_k < 1:
+        raise ValueError(f"top_k must be a positive integer, got {top_k}")
+    # Optional dependency, only needed for --engine igraph
+    import igraph as ig
+    indptr, indices, weights, is_disease, name_to_id, id_to_name = graph
+    start_ids = sorted({name_to_id[symptom] for symptom in symptoms})
+    if not start_ids:
+        return []
+    sources = np.repeat(np.arange(len(id_to_name), dtype=np.int32), np.diff(indptr))
+    keep = ~is_disease[sources] & (weights < np.inf)
+    g = ig.Graph(n=len(id_to_name), edges=np.column_stack([sources[keep], indices[keep]]).tolist(), directed=True)
+    g.es['weight'] = weights[keep].tolist()
+    
+    # One row of distances per symptom, the cost from all symptoms is the minimum over the rows
+    disease_ids = np.flatnonzero(is_disease)
+    distances = np.array(g.distances(source=start_ids, target=disease_ids.tolist(), weights='weight', mode='out'))
+    costs = distances.min(axis=0)
+    
+    # Sort the reached diseases by cumulative cost in ascending order (lower cost means higher likelihood)
+    reached = costs <= (np.inf if cost_cutoff is None else cost_cutoff)
+    reached &= costs < np.inf
+    disease_ids, costs = disease_ids[reached], costs[reached]
+    order = np.argsort(costs, kind='stable')[:top_k]
+    sorted_diseases = [(id_to_name[node], cost) for node, cost in zip(disease_ids[order].tolist(), costs[order].tolist())]
     
     return sorted_diseases
 
 def save_possible_diseases(diseases, output_path):
     try:
         with open(output_path, 'w', encoding='utf-8') as f:
-            for disease, score in diseases:
-                f.write(f"{disease}\t{score:.3f}\n")
+            f.write(''.join(f"{disease}\t{score:.3f}\n" for disease, score in diseases))
         print(f"Possible diseases have been saved to {output_path}")
     except Exception as e:
         print(f"Error writing to file {output_path}: {e}")
 
+def diagnose(graph, symptoms, top_k=None, cost_cutoff=None, engine='astar'):
+    """
+    Rank the possible diseases of the given symptoms in an already loaded knowledge graph.
+    Symptoms missing from the graph are ignored.
+    
+    Returns:
+        list of (str, float): Diseases and their cumulative costs, most likely first.
+    """
+    name_to_id = graph[4]
+    
+    # Check if symptoms exist in the graph
+    missing_symptoms = [s for s in symptoms if s not in name_to_id]
+    if missing_symptoms:
+        print(f"Warning: The following symptoms are not present in the knowledge graph and will be ignored: {missing_symptoms}")
+        symptoms = [s for s in symptoms if s in name_to_id]
+    
+    if not symptoms:
+        print("Error: No valid symptoms found in the knowledge graph.")
+        return []
+    
+    # Perform A* search to identify possible diseases
+    if engine == 'igraph':
+        print("Performing igraph shortest path search to identify possible diseases...")
+        return igraph_search(graph, symptoms, top_k=top_k, cost_cutoff=cost_cutoff)
+    print("Performing A* search to identify possible diseases...")
+    return a_star_search(graph, symptoms, top_k=top_k, cost_cutoff=cost_cutoff)
+
+def run(graph_path, symptoms, top_k=None, cost_cutoff=None, engine='astar'):
+    """
+    Load the knowledge graph and rank the possible diseases of the given symptoms, without any file output.
+    """
+    print("Loading knowledge graph...")
+    graph = load_graph(graph_path)
+    print("Knowledge graph loaded.")
+    return diagnose(graph, symptoms, top_k=top_k, cost_cutoff=cost_cutoff, engine=engine)
+
+def positive_int(value):
+    """
+    argparse type for options that only accept integers of at least 1.
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive integer, got {value}")
+    return number
+
 def main():
     parser = argparse.ArgumentParser(description="Stage 3: Identify possible diseases using A* algorithm.")
     parser.add_argument('--graph', required=True, type=str, help='Path to the input knowledge graph pickle file')
     parser.add_argument('--symptoms', required=True, type=str, help='Path to the input symptoms file')
     parser.add_argument('--output', type=str, default='possible_diseases.txt', help='Path to the output possible diseases file')
+    parser.add_argument('--top_k', type=positive_int, default=None, help='Only output the given number of most likely diseases')
+    parser.add_argument('--cost_cutoff', type=float, default=None, help='Only output diseases with a cumulative cost of at most this value')
+    parser.add_argument('--engine', type=str, default='astar', choices=['astar', 'igraph'], help='Search engine, igraph requires the igraph package')
     
     args = parser.parse_args()
     
-    # Load the knowledge graph
-    print("Loading knowledge graph...")
-    G = load_graph(args.graph)
-    print("Knowledge graph loaded.")
-    
     # Load the symptoms
     print("Loading symptoms...")
     symptoms = load_symptoms(args.symptoms)
     print(f"Loaded Symptoms: {symptoms}")
     
-    # Check if symptoms exist in the graph
-    missing_symptoms = [s for s in symptoms if s not in G.nodes()]
-    if missing_symptoms:
-        print(f"Warning: The following symptoms are not present in the knowledge graph and will be ignored: {missing_symptoms}")
-        symptoms = [s for s in symptoms if s in G.nodes()]
-    
-    if not symptoms:
-        print("Error: No valid symptoms found in the knowledge graph.")
-        return
-    
-    # Perform A* search to identify possible diseases
-    print("Performing A* search to identify possible diseases...")
-    sorted_diseases = a_star_search(G, symptoms)
+    sorted_diseases = run(args.graph, symptoms, top_k=args.top_k, cost_cutoff=args.cost_cutoff, engine=args.engine)
     
     if not sorted_diseases:
         print("No diseases identified based on the provided symptoms.")
@@ -8,6 +8,7 @@ Usage:
     --visualization: Visualization type, select static or interactive, default is static.
     --output_image: Output image path for static visualization, default is knowledge_graph.png.
     --output_html: Output HTML file path for interactive visualization, default is knowledge_graph.html.
+    --max_diseases: Only visualize the given positive number of diseases with the most symptoms, default is all of them.
         Default Example (Static Visualization, and default output file):
         `python3 get_knowledge_graph.py --csv DerivedKnowledgeGraph_final.csv`
         Static Visualization Example:
@@ -23,6 +24,8 @@ Input Format:
 
 Output Format:
     just run the script and it will save the knowledge graph to a pickle file and visualize it as a static or interactive graph.
+    The pickle file holds the CSR adjacency arrays of the graph, see graph_to_csr in get_diagnosis.py.
+    A NetworkX graph is only rebuilt from them for visualization.
 '''
 
 import os
@@ -31,50 +34,172 @@ os.environ["OPENBLAS_NUM_THREADS"] = "1"
 os.environ["OMP_NUM_THREADS"] = "1"
 
 import argparse
-import csv
 import networkx as nx
+import numpy as np
+import pandas as pd
 import pickle
-from pyvis.network import Network
-import matplotlib.pyplot as plt
+import re
+from numba import njit
+from get_diagnosis import neg_log_weights, positive_int
+
+# One "symptom (weight)" entry of the Symptoms column
+_SYMPTOM_RE = re.compile(r'([^,(]+?)\s*\(([\d.]+)\)')
 
 def build_knowledge_graph(csv_file):
+    """
+    Parse the CSV data straight into the CSR adjacency arrays searched by get_diagnosis.py.
+    Returns (indptr, indices, weights, is_disease, name_to_id, id_to_name), see graph_to_csr in get_diagnosis.py.
+    """
+    df = pd.read_csv(csv_file, dtype=str)
+    df.columns = ['disease', 'symptoms']
+    # (symptom, weight) pairs of every row, str.extractall would build a MultiIndex frame around the same matches
+    matches = [_SYMPTOM_RE.findall(row) for row in df['symptoms'].tolist()]
+    diseases = np.repeat(df['disease'].str.strip().str.lower().to_numpy(), [len(row) for row in matches])
+    pairs = [pair for row in matches for pair in row]
+    symptoms = np.array([symptom.strip().lower() for symptom, _ in pairs], dtype=object)
+    raw_weights = np.array([weight for _, weight in pairs], dtype=np.float32)
+
+    # Node ids follow the order in which diseases and symptoms first appear in the CSV
+    id_to_name = pd.unique(np.column_stack([diseases, symptoms]).ravel())
+    nodes = pd.Index(id_to_name)
+    src = nodes.get_indexer(diseases)
+    dst = nodes.get_indexer(symptoms)
+    # A repeated disease-symptom pair keeps its last weight
+    last = ~pd.DataFrame({'src': src, 'dst': dst}).duplicated(keep='last').to_numpy()
+    src, dst, raw_weights = src[last], dst[last], raw_weights[last]
+
+    # The graph is undirected, store each edge in both directions and group the edges by source node
+    sources = np.concatenate([src, dst])
+    targets = np.concatenate([dst, src])
+    order = np.argsort(sources, kind='stable')
+    indptr = np.zeros(len(id_to_name) + 1, dtype=np.int32)
+    np.cumsum(np.bincount(sources, minlength=len(id_to_name)), out=indptr[1:])
+    indices = targets[order].astype(np.int32)
+    weights = neg_log_weights(np.concatenate([raw_weights, raw_weights])[order])
+    is_disease = nodes.isin(diseases)
+
+    id_to_name = id_to_name.tolist()
+    name_to_id = {node: i for i, node in enumerate(id_to_name)}
+    return indptr, indices, weights, is_disease, name_to_id, id_to_name
+
+def to_networkx(graph):
+    """
+    Rebuild a NetworkX graph from the CSR arrays, only used for visualization.
+    """
+    indptr, indices, weights, is_disease, name_to_id, id_to_name = graph
     G = nx.Graph()
-    with open(csv_file, 'r', encoding='utf-8') as f:
-        reader = csv.reader(f)
-        next(reader)  # Skip header
-        index = 0
-        for row in reader:
-            disease = row[0].strip().lower()
-            symptoms_data = row[1].split(',')
-            for symptom_info in symptoms_data:
-                symptom, weight = symptom_info.strip().rsplit(' ', 1)
-            
-                if index == 0:
-                    print(symptom_info)
-                    print(symptom)
-                    print(float(weight.strip('()')))
-                
-                weight = float(weight.strip('()'))
-                G.add_node(disease, title=disease, group='disease', color='red', size=30)
-                G.add_node(symptom, title=symptom, group='symptom', color='blue', size=10)
-                G.add_edge(disease, symptom, weight=weight)
-            index += 1
+    # Only the group is stored per node, colors and sizes are derived from it when drawing
+    G.add_nodes_from((node, {'group': 'disease' if disease else 'symptom'})
+                     for node, disease in zip(id_to_name, is_disease.tolist()))
+    sources = np.repeat(np.arange(len(id_to_name), dtype=np.int32), np.diff(indptr))
+    # Each undirected edge is stored twice in the CSR arrays, keep one direction
+    forward = sources < indices
+    raw_weights = np.exp(-weights[forward].astype(np.float64)).round(3)
+    G.add_edges_from((id_to_name[u], id_to_name[v], {'weight': weight})
+                     for u, v, weight in zip(sources[forward].tolist(), indices[forward].tolist(), raw_weights.tolist()))
     return G
 
-def save_graph_to_file(G, file_path):
+# Node colors and sizes used by the visualizations, keyed by node group
+NODE_COLORS = {'disease': 'red', 'symptom': 'blue'}
+NODE_SIZES = {'disease': 30, 'symptom': 10}
+
+def save_graph_to_file(graph, file_path):
+    # Protocol 5 pickles the numpy arrays as raw buffers instead of copying them through bytes objects
     with open(file_path, 'wb') as f:
-        pickle.dump(G, f)
+        pickle.dump(graph, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+@njit(cache=True)
+def _fruchterman_reingold(pos, sources, targets, edge_weights, iterations, k):
+    """
+    Fruchterman-Reingold force-directed layout compiled with Numba, same forces and cooling as nx.spring_layout,
+    the attraction along each edge being scaled by its weight.
+    """
+    n = pos.shape[0]
+    # The initial "temperature" is about .1 of the domain, linearly cooled down on each iteration
+    t = max(pos[:, 0].max() - pos[:, 0].min(), pos[:, 1].max() - pos[:, 1].min()) * 0.1
+    dt = t / (iterations + 1)
+    displacement = np.zeros_like(pos)
+    for _ in range(iterations):
+        displacement[:] = 0.0
+        # Repulsion between every pair of nodes
+        for i in range(n):
+            for j in range(i + 1, n):
+                dx = pos[i, 0] - pos[j, 0]
+                dy = pos[i, 1] - pos[j, 1]
+                force = k * k / max(dx * dx + dy * dy, 1e-4)
+                displacement[i, 0] += dx * force
+                displacement[i, 1] += dy * force
+                displacement[j, 0] -= dx * force
+                displacement[j, 1] -= dy * force
+        # Attraction along the edges, proportional to the edge weight
+        for e in range(len(sources)):
+            i, j = sources[e], targets[e]
+            dx = pos[i, 0] - pos[j, 0]
+            dy = pos[i, 1] - pos[j, 1]
+            force = max(np.sqrt(dx * dx + dy * dy), 0.01) / k * edge_weights[e]
+            displacement[i, 0] -= dx * force
+            displacement[i, 1] -= dy * force
+            displacement[j, 0] += dx * force
+            displacement[j, 1] += dy * force
+        # Move each node by at most the current temperature
+        for i in range(n):
+            length = max(np.sqrt(displacement[i, 0] ** 2 + displacement[i, 1] ** 2), 0.01)
+            pos[i, 0] += displacement[i, 0] * t / length
+            pos[i, 1] += displacement[i, 1] * t / length
+        t -= dt
+    return pos
+
+def spring_layout(G, scale=1, iterations=50, seed=None):
+    """
+    Replacement for nx.spring_layout with its default weight='weight' (edges without a weight count as 1):
+    nx switches to a per-node Python loop on graphs with 500 nodes or more, this runs the whole layout in the
+    compiled kernel above. Positions differ from nx for the same seed, as the initial positions are drawn differently.
+    """
+    nodes = list(G)
+    if not nodes:
+        return {}
+    node_ids = {node: i for i, node in enumerate(nodes)}
+    edges = np.array([(node_ids[u], node_ids[v]) for u, v in G.edges()], dtype=np.int64).reshape(-1, 2)
+    edge_weights = np.array([weight for u, v, weight in G.edges(data='weight', default=1)], dtype=np.float64)
+    pos = np.random.default_rng(seed).random((len(nodes), 2))
+    pos = _fruchterman_reingold(pos, edges[:, 0], edges[:, 1], edge_weights, iterations, np.sqrt(1.0 / len(nodes)))
+    # Center on the origin and scale to [-scale, scale]
+    pos -= pos.mean(axis=0)
+    extent = np.abs(pos).max()
+    if extent > 0:
+        pos *= scale / extent
+    return dict(zip(nodes, pos))
+
+def top_diseases_subgraph(G, max_diseases):
+    """
+    Induced subgraph of the max_diseases diseases with the most symptoms and their symptoms.
+    """
+    if max_diseases < 1:
+        raise ValueError(f"max_diseases must be a positive integer, got {max_diseases}")
+    diseases = [node for node, data in G.nodes(data=True) if data['group'] == 'disease']
+    diseases = sorted(diseases, key=G.degree, reverse=True)[:max_diseases]
+    nodes = set(diseases)
+    for disease in diseases:
+        nodes.update(G.neighbors(disease))
+    return G.subgraph(nodes)
 
 def get_label_position(pos, offset_x=0.0, offset_y=10):
     return {node: (coords[0] + offset_x, coords[1] + offset_y) for node, coords in pos.items()}
 
-def visualize_graph(G, visualization_type, output_image=None, output_html=None):
+def visualize_graph(G, visualization_type, output_image=None, output_html=None, max_diseases=None):
+    # Imported here so building the graph does not pay for loading the plotting libraries
+    import matplotlib.pyplot as plt
+    from pyvis.network import Network
+
+    if max_diseases is not None:
+        # Large graphs are unreadable anyway, only draw the best connected diseases
+        G = top_diseases_subgraph(G, max_diseases)
     if visualization_type == 'static':
         # Use matplotlib to create a static image
-        pos = nx.spring_layout(G, scale=200)  # positions for all nodes with more space
+        pos = spring_layout(G, scale=200)  # positions for all nodes with more space
         # nodes
         node_sizes = [1 * G.degree[n] for n in G]  # size nodes based on degree
-        nx.draw_networkx_nodes(G, pos, node_size=node_sizes, node_color=[data['color'] for v, data in G.nodes(data=True)])
+        nx.draw_networkx_nodes(G, pos, node_size=node_sizes, node_color=[NODE_COLORS[data['group']] for v, data in G.nodes(data=True)])
         # edges
         nx.draw_networkx_edges(G, pos, width=0.5, alpha=0.5)
         # labels
@@ -91,7 +216,7 @@ def visualize_graph(G, visualization_type, output_image=None, output_html=None):
         # Interactive visualization using pyvis
         net = Network(notebook=False)
         for node, data in G.nodes(data=True):
-            net.add_node(node, title=node, color=data['color'], size=data['size'])
+            net.add_node(node, title=node, color=NODE_COLORS[data['group']], size=NODE_SIZES[data['group']])
         for source, target, data in G.edges(data=True):
             net.add_edge(source, target, title=f"Weight: {data['weight']}")
         net.show_buttons(filter_=['physics'])
@@ -105,20 +230,22 @@ def main():
     parser.add_argument('--visualization', type=str, default='static', choices=['static', 'interactive'], help='Visualization type')
     parser.add_argument('--output_image', type=str, default='knowledge_graph.png', help='Output image path for static visualization')
     parser.add_argument('--output_html', type=str, default='knowledge_graph.html', help='Output HTML file path for interactive visualization')
+    parser.add_argument('--max_diseases', type=positive_int, default=None, help='Only visualize the given number of diseases with the most symptoms')
 
     args = parser.parse_args()
 
     # Build the knowledge graph from the CSV data
-    G = build_knowledge_graph(args.csv)
+    graph = build_knowledge_graph(args.csv)
 
     # Save the graph to a pickle file
-    save_graph_to_file(G, args.graph_output)
+    save_graph_to_file(graph, args.graph_output)
 
     # Visualize the graph based on the selected visualization type
+    G = to_networkx(graph)
     if args.visualization == 'static':
-        visualize_graph(G, 'static', output_image=args.output_image)
+        visualize_graph(G, 'static', output_image=args.output_image, max_diseases=args.max_diseases)
     elif args.visualization == 'interactive':
-        visualize_graph(G, 'interactive', output_html=args.output_html)
+        visualize_graph(G, 'interactive', output_html=args.output_html, max_diseases=args.max_diseases)
 
     print(f"Knowledge graph has been built and visualized. Data saved to {args.graph_output}.")
 
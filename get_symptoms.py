@@ -34,81 +34,174 @@ Output Format:
 '''
 
 import os
-# set the number of threads to 1 for better performance cuz purdue server sucks!
-os.environ["OPENBLAS_NUM_THREADS"] = "1"
-os.environ["OMP_NUM_THREADS"] = "1"
-import openai
+import json
+import re
+import hashlib
+import inspect
+import tempfile
+from functools import wraps
+from openai import OpenAI, RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 import argparse
 import sys
 
+MODEL = "gpt-4o-mini"
+SYSTEM_PROMPT = (
+    "You are an experienced medical assistant. Your task is to identify and output the key symptoms mentioned in the patient's description. "
+    "Output only a JSON object with a \"symptoms\" list of concise symptoms, such as if the description is 'The patient is experiencing severe abdominal pain, nausea, and vomiting. They also report occasional heartburn and difficulty swallowing.' Then the output is {\"symptoms\": [\"severe abdominal pain\", \"nausea\", \"vomiting\", \"heartburn\", \"difficulty swallowing\"]}. "
+    "Do not include extra information or explanations or part name."
+)
+# Transient OpenAI errors worth another attempt: rate limits, timeouts, network and server errors
+RETRY_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+# Up to 3 attempts with exponential backoff, the last error is raised as is
+openai_retry = retry(stop=stop_after_attempt(3), wait=wait_exponential(min=1, max=30),
+                     retry=retry_if_exception_type(RETRY_ERRORS), reraise=True)
+# Leading list marker such as "1.", "10)" or "-" that the model sometimes keeps in front of a symptom
+_LIST_MARKER_RE = re.compile(r'^\s*(?:\d+[.)]|[-*•])\s+')
+# Directory of the extracted symptoms cache, one JSON file per patient description
+CACHE_DIR = os.getenv('SYMPTOM_CACHE_DIR', '.symptom_cache')
+# Bump to invalidate all cached symptoms, e.g. after changing how answers are parsed
+CACHE_VERSION = 2
+
+def build_request(patient_description):
+    """
+    Chat completion parameters to extract the symptoms of one patient description.
+    """
+    return {
+        "model": MODEL,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"Patient Description:\n{patient_description}"},
+        ],
+        # JSON mode makes the answer parseable with a single json.loads
+        "response_format": {"type": "json_object"},
+        "max_tokens": 150,
+        "temperature": 0.3,
+    }
+
+def parse_symptoms(content):
+    """
+    Symptoms of a JSON mode answer. Raises ValueError when the answer is not a {"symptoms": [...]} object of strings.
+    """
+    if not isinstance(content, str):
+        raise ValueError(f"Expected a JSON string answer, got {type(content).__name__}")
+    answer = json.loads(content)
+    symptoms = answer.get("symptoms", []) if isinstance(answer, dict) else None
+    if not isinstance(symptoms, list) or not all(isinstance(symptom, str) for symptom in symptoms):
+        raise ValueError(f"Unexpected answer format: {content}")
+    symptoms = (_LIST_MARKER_RE.sub('', symptom).strip().lower() for symptom in symptoms)
+    return [symptom for symptom in symptoms if symptom]
+
+@openai_retry
+def create_completion(client, patient_description):
+    """
+    Send the symptom extraction request, retried on transient errors. Parsing is left to the caller so it is never retried.
+    """
+    return client.chat.completions.create(**build_request(patient_description))
+
+@openai_retry
+async def acreate_completion(client, patient_description):
+    return await client.chat.completions.create(**build_request(patient_description))
+
+def cache_path(patient_description):
+    """
+    Cache file of a patient description, keyed on the whole request so a new model or prompt misses the cache.
+    """
+    request = json.dumps([CACHE_VERSION, build_request(patient_description)], sort_keys=True)
+    return os.path.join(CACHE_DIR, hashlib.sha256(request.encode('utf-8')).hexdigest() + '.json')
+
+def load_cached_symptoms(patient_description):
+    try:
+        with open(cache_path(patient_description), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def store_cached_symptoms(patient_description, symptoms):
+    # Failed extractions are not cached, so they are retried on the next run
+    if not symptoms:
+        return
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # Write to a temporary file and rename it, so a reader never sees a partial entry
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(symptoms, f)
+    os.replace(tmp_path, cache_path(patient_description))
+
+def cached(extract):
+    """
+    Serve extract(patient_description, ...) from the disk cache, only calling OpenAI for new descriptions.
+    Works for both the sync and the async extraction functions.
+    """
+    if inspect.iscoroutinefunction(extract):
+        @wraps(extract)
+        async def cached_extract(patient_description, *args):
+            symptoms = load_cached_symptoms(patient_description)
+            if symptoms is None:
+                symptoms = await extract(patient_description, *args)
+                store_cached_symptoms(patient_description, symptoms)
+            return symptoms
+    else:
+        @wraps(extract)
+        def cached_extract(patient_description, *args):
+            symptoms = load_cached_symptoms(patient_description)
+            if symptoms is None:
+                symptoms = extract(patient_description, *args)
+                store_cached_symptoms(patient_description, symptoms)
+            return symptoms
+    return cached_extract
+
+@cached
 def extract_symptoms(patient_description, api_key):
-    openai.api_key = api_key
+    # Retries are handled by openai_retry, not by the client
+    client = OpenAI(api_key=api_key, max_retries=0)
 
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4",  # 确保使用正确的模型名称
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are an experienced medical assistant. Your task is to identify and output the key symptoms mentioned in the patient's description. "
-                        "Output only a concise comma-separated list of symptoms, such as if the description is 'The patient is experiencing severe abdominal pain, nausea, and vomiting. They also report occasional heartburn and difficulty swallowing.' Then the symptoms we get are 'severe abdominal pain, nausea, vomiting, heartburn, difficulty swallowing'. "
-                    "Do not include extra information or explanations or part name."
-                    )
-                },
-                {
-                    "role": "user",
-                    "content": f"Patient Description:\n{patient_description}"
-                }
-            ],
-            max_tokens=150,
-            temperature=0.3,
-            n=1,
-            stop=None,
-        )
-
-        #print(f"ChatGPT Response: {response}")
-
-        # 提取症状文本
-        symptoms_text = response['choices'][0]['message']['content'].strip()
-
-        # 检查是否为逗号分隔的列表
-        if ',' in symptoms_text:
-            # 按逗号分割并清理每个症状
-            symptoms_list = [symptom.strip().lower() for symptom in symptoms_text.split(',') if symptom.strip()]
-        else:
-            # 处理编号列表的情况
-            symptoms_list = []
-            for line in symptoms_text.split('\n'):
-                line = line.strip()
-                if line and line[0].isdigit():  # 检查行是否以数字开头
-                    # 分割编号和症状
-                    parts = line.split('.', 1)
-                    if len(parts) == 2:
-                        symptom = parts[1].strip().lower()
-                        symptoms_list.append(symptom)
-
-        return symptoms_list
+        response = create_completion(client, patient_description)
+        return parse_symptoms(response.choices[0].message.content)
+
+    except Exception as e:
+        print(f"Error communicating with OpenAI API: {e}")
+        return []
+
+@cached
+async def aextract_symptoms(patient_description, client):
+    """
+    Async variant of extract_symptoms, sharing one AsyncOpenAI client so many descriptions can be processed concurrently.
+    """
+    try:
+        response = await acreate_completion(client, patient_description)
+        return parse_symptoms(response.choices[0].message.content)
 
     except Exception as e:
         print(f"Error communicating with OpenAI API: {e}")
         return []
 
+def run(patient_description, api_key):
+    """
+    Extract the symptoms of a patient description with ChatGPT, without any file output.
+    
+    Returns:
+        list of str: Extracted symptoms, empty if none could be extracted.
+    """
+    if not patient_description.strip():
+        return []
+    return extract_symptoms(patient_description, api_key)
+
 def manual_input_symptoms():
     print("Please enter all symptoms you get from ChatGPT in one line, separated by commas.")
     print("Example Format: severe abdominal pain, nausea, vomiting, occasional heartburn, difficulty swallowing")
     symptom_line = input("Enter Symptoms: ").strip().lower()
     if not symptom_line:
         return []
-    # Split the input line by commas and strip whitespace
-    symptoms = [symptom.strip() for symptom in symptom_line.split(',') if symptom.strip()]
-    return symptoms
+    # Split the input line by commas and strip whitespace, once per symptom
+    symptoms = (symptom.strip() for symptom in symptom_line.split(','))
+    return [symptom for symptom in symptoms if symptom]
 
 def save_symptoms(symptoms, output_path):
     try:
         with open(output_path, 'w', encoding='utf-8') as f:
-            for symptom in symptoms:
-                f.write(symptom + '\n')
+            f.write(''.join(f"{symptom}\n" for symptom in symptoms))
         print(f"Symptoms have been saved to {output_path}")
     except Exception as e:
         print(f"Error writing to file {output_path}: {e}")
@@ -155,7 +248,7 @@ def main():
             sys.exit(1)
 
         # Extract symptoms from the patient description
-        symptoms = extract_symptoms(patient_description, api_key)
+        symptoms = run(patient_description, api_key)
         if symptoms:
             print(f"\nExtracted Symptoms: {symptoms}")
             save_symptoms(symptoms, args.output)
@@ -4,8 +4,9 @@ Topic:
 
 Description:
     This script processes a dataset of patient descriptions to evaluate the accuracy of a medical diagnosis system.
-    For each patient case, it extracts symptoms using an external script (`get_symptoms.py`), predicts possible diseases
-    using another external script (`get_diagnosis.py`), and compares the predictions against the ground truth labels.
+    It first extracts the symptoms of all patient cases concurrently with the async OpenAI client (`get_symptoms.py`),
+    then for each case predicts possible diseases in-process with the diagnosis stage (`get_diagnosis.py`), and compares
+    the predictions against the ground truth labels.
     The script tracks the number of correct and incorrect predictions for each disease and provides overall statistics.
 
 Usage:
@@ -20,20 +21,18 @@ Usage:
     ```bash
     python3 kaggle_test.py sk-your-api-key-here 1
     ```
+    Add `--batch` to extract the symptoms of all lines with a single OpenAI Batch API job instead,
+    which costs half as much but may take up to 24 hours.
 
 Output:
     ```
-    -----------------Diagnose Start-----------------
-
-    Extracted Symptoms: ['skin rash', 'itchiness', 'dry scaly patches']
-    Symptoms have been saved to symptoms.txt
     Loading knowledge graph...
     Knowledge graph loaded.
-    Loading symptoms...
-    Loaded Symptoms: ['skin rash', 'itchiness', 'dry scaly patches']
+
+    -----------------Diagnose Start-----------------
+    Extracted Symptoms: ['skin rash', 'itchiness', 'dry scaly patches']
     Warning: The following symptoms are not present in the knowledge graph and will be ignored: ['itchiness', 'dry scaly patches']
     Performing A* search to identify possible diseases...
-    Possible diseases have been saved to possible_diseases.txt
     Disease Ground Truth: Psoriasis
     Loading: --------------
     Diagnose complete!
@@ -49,140 +48,206 @@ Output:
     ```
 
 Notes:
-    - **Performance Considerations:** Processing a large number of patient cases may be time-consuming, especially if external scripts are slow. Optimize external scripts for better performance if necessary.
+    - **Performance Considerations:** Processing a large number of patient cases may be time-consuming, mostly because of the OpenAI requests. Both stages run in-process, without intermediate files.
     - **Extensibility:** The knowledge graph used by the diagnosis script can be expanded to improve accuracy over time.
 '''
 
 import os
-os.environ["OPENBLAS_NUM_THREADS"] = "1"
-os.environ["OMP_NUM_THREADS"] = "1"
 import pandas as pd
-import subprocess
 import kagglehub
 import sys
 from collections import defaultdict
 import argparse
+import asyncio
+import json
+import time
+from openai import OpenAI, AsyncOpenAI
+from get_symptoms import aextract_symptoms, build_request, parse_symptoms, load_cached_symptoms, store_cached_symptoms
+from get_diagnosis import load_graph, diagnose
+
+# Maximum number of concurrent OpenAI requests when extracting symptoms
+MAX_CONCURRENT_REQUESTS = 10
+# Bounds in seconds of the exponential backoff between two Batch API status checks
+BATCH_POLL_MIN_DELAY = 5
+BATCH_POLL_MAX_DELAY = 300
+
+async def extract_all_symptoms(texts, api_key):
+    """
+    Extracts symptoms from all input texts concurrently, in-process with the async OpenAI client.
+    
+    Parameters:
+        texts (list of str): The input texts containing patient information.
+        api_key (str): The API key for authentication.
+        
+    Returns:
+        list of list of str: Extracted symptoms, in the order of texts.
+    """
+    # Retries are handled by aextract_symptoms, not by the client
+    client = AsyncOpenAI(api_key=api_key, max_retries=0)
+    # Bound the number of requests in flight to stay within the rate limits
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    
+    async def extract(text):
+        async with semaphore:
+            return await aextract_symptoms(text, client)
+    
+    return await asyncio.gather(*(extract(text) for text in texts))
 
-def extract_symptoms(text, api_key):
+def build_batch_jsonl(data, line_threshold):
     """
-    Extracts symptoms from the input text using an external script.
+    Builds the Batch API input file, one chat completion request per processed line.
     
     Parameters:
-        text (str): The input text containing patient information.
+        data (DataFrame): The Symptom2Disease dataset.
+        line_threshold (int): The number of lines to process from the CSV file.
+        
+    Returns:
+        str: JSONL content, each request identified by the index of its row.
+    """
+    requests = [
+        json.dumps({
+            "custom_id": str(index),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_request(text),
+        })
+        for index, text in data['text'].head(line_threshold).items()
+    ]
+    return '\n'.join(requests) + '\n'
+
+def extract_all_symptoms_batch(data, line_threshold, api_key):
+    """
+    Extracts symptoms from all processed lines with a single OpenAI Batch API job.
+    Batch requests cost half as much and use a separate rate limit pool, but may take up to 24 hours.
+    
+    Parameters:
+        data (DataFrame): The Symptom2Disease dataset.
+        line_threshold (int): The number of lines to process from the CSV file.
         api_key (str): The API key for authentication.
         
     Returns:
-        str: Extracted symptoms.
+        list of list of str: Extracted symptoms, in the order of the rows.
+    """
+    texts = data['text'].head(line_threshold)
+    # Only submit the descriptions that are not cached yet
+    symptoms = {str(index): load_cached_symptoms(text) for index, text in texts.items()}
+    pending = data.head(line_threshold)[[symptoms[str(index)] is None for index in texts.index]]
+    if pending.empty:
+        return [symptoms[str(index)] for index in texts.index]
+    
+    client = OpenAI(api_key=api_key)
+    batch_input = client.files.create(file=('batch_input.jsonl', build_batch_jsonl(pending, len(pending)).encode('utf-8')), purpose='batch')
+    batch = client.batches.create(input_file_id=batch_input.id, endpoint='/v1/chat/completions', completion_window='24h')
+    print(f"Submitted batch {batch.id}, waiting for it to complete...")
+    
+    # Poll the batch status with exponential backoff
+    delay = BATCH_POLL_MIN_DELAY
+    while batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+        time.sleep(delay)
+        delay = min(delay * 2, BATCH_POLL_MAX_DELAY)
+        batch = client.batches.retrieve(batch.id)
+    
+    if batch.status != 'completed' or batch.output_file_id is None:
+        print(f"Error: Batch {batch.id} ended with status {batch.status}.")
+    else:
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            result = json.loads(line)
+            response = result['response']
+            if response is None or response['status_code'] != 200:
+                print(f"Error in batch request {result['custom_id']}: {result['error']}")
+                continue
+            try:
+                symptoms[result['custom_id']] = parse_symptoms(response['body']['choices'][0]['message']['content'])
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                # A malformed answer only loses its own line, not the whole batch
+                print(f"Error parsing batch response {result['custom_id']}: {e!r}")
+                continue
+            store_cached_symptoms(texts[int(result['custom_id'])], symptoms[result['custom_id']])
+    
+    return [symptoms[str(index)] or [] for index in texts.index]
+
+def process_row(graph, disease_gt, Extracted_Symptoms):
+    """
+    Diagnoses one patient case and compares the prediction with its ground truth label.
+    
+    Parameters:
+        graph (tuple): The knowledge graph, as returned by load_graph.
+        disease_gt (str): The ground truth label of the patient case.
+        Extracted_Symptoms (list of str): The symptoms extracted from the patient description.
+        
+    Returns:
+        bool: Whether the ground truth disease was predicted.
     """
-    # Remove existing temporary files if they exist
-    if os.path.exists('symptoms.txt'):
-        os.remove('symptoms.txt')
-    if os.path.exists('temp_input.txt'):
-        os.remove('temp_input.txt')
-    
-    # Write the input text to a temporary file
-    with open('temp_input.txt', 'w') as f:
-        f.write(text)
-    
-    # Call the external script to extract symptoms
-    subprocess.run([
-        'python3', 'get_symptoms.py',
-        '--input', 'temp_input.txt',
-        '--output', 'symptoms.txt',
-        '--api', api_key
-    ])
-    
-    # Read and return the extracted symptoms
-    with open('symptoms.txt', 'r') as f:
-        symptoms = f.read().strip()
-    
-    return symptoms
+    print()
+    print("-----------------Diagnose Start-----------------")
+    print(f"Extracted Symptoms: {Extracted_Symptoms}")
+    
+    # Rank the possible diseases in-process
+    diseases = diagnose(graph, Extracted_Symptoms)
+    
+    if not diseases:
+        print('Cannot find possible diseases')
+        print("-----------------Diagnose End-----------------")
+        print()
+        # Count as incorrect since we couldn't make a prediction
+        return False
+    
+    print(f"Disease Ground Truth: {disease_gt}")
+    print("Loading: --------------")
+    print(f"Diagnose complete!")
+    
+    # Compare the ranked possible diseases with the ground truth, lowercased once
+    gt_lc = disease_gt.lower()
+    # Stop scanning at the ground truth instead of lowercasing every ranked disease
+    predicted = next(((disease_name, cost) for disease_name, cost in diseases if disease_name.lower() == gt_lc), None)
+    correct = predicted is not None
+    # Report the ground truth when it was predicted, the most likely disease otherwise
+    disease_name, cost = predicted if correct else diseases[0]
+    print(f"Predicted Disease is: {disease_name}\t{cost:.3f}")
+    
+    print("-----------------Diagnose End-----------------")
+    print()
+    return correct
 
-def main(api_key, line_threshold):
+def main(api_key, line_threshold, batch=False):
     """
     Main function to perform diagnosis and evaluate accuracy.
     
     Parameters:
         api_key (str): The API key for authentication.
         line_threshold (int): The number of lines to process from the CSV file.
+        batch (bool): Whether to extract the symptoms with the OpenAI Batch API.
     """
+    # Load the knowledge graph once, all rows share it read-only. Loaded first so a missing or
+    # unreadable pickle fails right away rather than after the symptom extraction, up to 24h with --batch
+    print("Loading knowledge graph...")
+    graph = load_graph('knowledge_graph.pkl')
+    print("Knowledge graph loaded.")
+    
     # Download the dataset from Kaggle
     path = kagglehub.dataset_download("niyarrbarman/symptom2disease")
-    data = pd.read_csv(os.path.join(path, "Symptom2Disease.csv"))
+    # Only parse the columns and lines that are processed
+    data = pd.read_csv(os.path.join(path, "Symptom2Disease.csv"), usecols=['text', 'label'], nrows=line_threshold,
+                       dtype={'text': 'string', 'label': 'category'})
+    
+    # Extract the symptoms of all processed lines up front, the OpenAI requests run concurrently or as one batch
+    if batch:
+        all_symptoms = extract_all_symptoms_batch(data, line_threshold, api_key)
+    else:
+        all_symptoms = asyncio.run(extract_all_symptoms(data['text'].head(line_threshold).tolist(), api_key))
     
     # Initialize a dictionary to keep counts of correct and incorrect predictions per disease
     counts = defaultdict(lambda: {'correct': 0, 'incorrect': 0})
     
-    line = 0  # Initialize line counter
-    
-    for index, row in data.iterrows():
-        if line >= line_threshold:
-            break  # Exit the loop once the line threshold is reached
-
-        print()
-        print("-----------------Diagnose Start-----------------")
-        disease_gt = row['label']
-    
-        # Extract symptoms from the text
-        Extracted_Symptoms = extract_symptoms(row['text'], api_key)
-        
-        # Call the diagnosis script
-        if os.path.exists('possible_diseases.txt'):
-            os.remove('possible_diseases.txt')
-        
-        subprocess.run([
-            'python3', 'get_diagnosis.py',
-            '--graph', 'knowledge_graph.pkl',
-            '--symptoms', 'symptoms.txt',
-            '--output', 'possible_diseases.txt'
-        ])
-        
-        if not os.path.exists('possible_diseases.txt'):
-            print('Cannot find possible diseases')
-            line += 1
-            print("-----------------Diagnose End-----------------")
-            print()
-            # Increment the incorrect count since we couldn't make a prediction
-            counts[disease_gt]['incorrect'] += 1
-            continue
-        
-        # Initialize flags and variables for prediction
-        flag = 0
-        line_t = 0
-        first_possible_disease = ''
-    
-        print(f"Disease Ground Truth: {disease_gt}")
-        print("Loading: --------------")
-        print(f"Diagnose complete!")
-        
-        # Read the possible diseases from the output file
-        with open('possible_diseases.txt', 'r') as f:
-            diseases = f.read()
-            for disease in diseases.split('\n'):
-                if not disease.strip():
-                    continue  # Skip empty lines
-                if line_t == 0:
-                    first_possible_disease = disease
-                    line_t += 1
-                # Split the disease entry by tab and compare with ground truth
-                disease_name = disease.split('\t')[0].lower()
-                if disease_name == disease_gt.lower() and flag == 0:
-                    print(f"Predicted Disease is: {disease}")
-                    flag = 1
-                    break
-            if flag == 0:
-                print(f"Predicted Disease is: {first_possible_disease}")
-        
+    # Plain lists avoid boxing every row into a Series
+    labels = data['label'].head(line_threshold).tolist()
+    for disease_gt, Extracted_Symptoms in zip(labels, all_symptoms):
         # Update counts based on prediction result
-        if flag == 1:
+        if process_row(graph, disease_gt, Extracted_Symptoms):
             counts[disease_gt]['correct'] += 1
         else:
             counts[disease_gt]['incorrect'] += 1
     
-        line += 1
-        print("-----------------Diagnose End-----------------")
-        print()
-    
     # Print out the statistics after processing
     print("---------Diagnosis Statistics---------")
     for disease, count in counts.items():
@@ -201,6 +266,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Medical Diagnosis Evaluation Script")
     parser.add_argument('API_KEY', type=str, help='Your API key for authentication.')
     parser.add_argument('line_threshold', type=int, help='Number of lines to process from the CSV file.')
+    parser.add_argument('--batch', action='store_true', help='Extract symptoms with the OpenAI Batch API (half the cost, up to 24h turnaround).')
     
     # Parse the arguments
     args = parser.parse_args()
@@ -211,4 +277,4 @@ if __name__ == "__main__":
         sys.exit(1)
     
     # Call the main function with parsed arguments
-    main(args.API_KEY, args.line_threshold)
+    main(args.API_KEY, args.line_threshold, batch=args.batch)